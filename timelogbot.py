@@ -12,12 +12,17 @@ __author__ = "Martin Dahlö, inherited from Marcel Martin"
 
 
 from argparse import ArgumentParser
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime, date, timedelta
 from email.mime.text import MIMEText
-from itertools import groupby
+from math import fsum
+from operator import itemgetter
+from urllib.parse import urljoin
 from redminelib import Redmine as Redmine_api
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
 import re
@@ -38,6 +43,34 @@ CHECKPOINT_HOURS = (100, 300)
 # Send a notification when a project reaches this number of days since the first logged hour
 CHECKPOINT_DAYS = 365
 
+# Number of concurrent requests made to Redmine and Confluence
+MAX_WORKERS = 8
+
+# Issue subjects that can be used as project id when there is no WABI ID attribute
+WABI_ID_PATTERN = re.compile(r'.*_\d{4}')
+
+# Maximum number of space ids to look up with a single Confluence request
+SPACE_IDS_PER_REQUEST = 250
+
+# Separates the custom text of a page from the report. The space in this
+# constant is needed since the HTML gets cleaned up after uploading.
+REPORT_MARKER = "<hr />"
+
+# Summary line of a previously generated report, searched for within the
+# first REPORT_HEADER_LENGTH characters following the report marker
+REPORT_PATTERN = re.compile(r"(\d+(?:\.\d+)?) out of (\d+(?:\.\d+)?) hours used")
+REPORT_HEADER_LENGTH = 500
+
+# Replacements of special characters in project ids
+PROJECT_ID_TRANSLATION = str.maketrans({
+    "ö": "o",
+    "ä": "a",
+    "å": "a",
+    "Ö": "O",
+    "Ä": "A",
+    "Å": "A",
+})
+
 
 
 
@@ -49,12 +82,27 @@ class Database:
             database_path, detect_types=sqlite3.PARSE_DECLTYPES
         )
         self.cursor = self.connection.cursor()
+        # All changes of a run are committed in a single transaction
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        # Project hours not yet written to the database
+        self.pending = {}
         self.cursor.execute(
             "CREATE TABLE IF NOT EXISTS projects (name TEXT PRIMARY KEY NOT NULL, hours FLOAT, "
             "date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
         )
+        self.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS monthly (name TEXT NOT NULL, year INTEGER, month INTEGER, "
+            "hours FLOAT, PRIMARY KEY (name, year, month))"
+        )
+        self.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS pages (id TEXT PRIMARY KEY NOT NULL, etag TEXT, "
+            "hours FLOAT, budget FLOAT, last_date DATE, version INTEGER, title TEXT, head TEXT)"
+        )
 
     def __getitem__(self, name):
+        if name in self.pending:
+            return self.pending[name], date.today()
         self.cursor.execute("SELECT hours, date FROM projects WHERE name = ?", (name,))
         result = self.cursor.fetchone()
         if result is None:
@@ -62,69 +110,244 @@ class Database:
         return result[0], result[1].date()
 
     def __setitem__(self, name, hours):
+        self.pending[name] = hours
+
+    def monthly_hours(self, name):
+        """Return a list of (year, month, hours) tuples, most recent month first"""
+        self.cursor.execute(
+            "SELECT year, month, hours FROM monthly WHERE name = ? "
+            "ORDER BY year DESC, month DESC",
+            (name,),
+        )
+        return self.cursor.fetchall()
+
+    def set_monthly_hours(self, name, totals, removed=()):
+        """
+        Store the given {(year, month): hours} totals of a project and delete
+        the months in removed, an iterable of (year, month) tuples
+        """
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO monthly (name, year, month, hours) VALUES (?, ?, ?, ?)",
+            [(name, year, month, hours) for (year, month), hours in totals.items()],
+        )
+        self.cursor.executemany(
+            "DELETE FROM monthly WHERE name = ? AND year = ? AND month = ?",
+            [(name, year, month) for year, month in removed],
+        )
+
+    def pages(self):
+        """
+        Return the state of the report pages as of their last retrieval or
+        update as a {page_id: {"etag": ..., "hours": ..., ...}} dict. See
+        Confluence.remember_page() for all keys.
+        """
         self.cursor.execute(
-            "INSERT OR REPLACE INTO projects (name, hours) VALUES (?, ?)", (name, hours)
+            "SELECT id, etag, hours, budget, last_date, version, title, head FROM pages"
+        )
+        return {
+            page_id: {
+                "etag": etag,
+                "hours": hours,
+                "budget": budget,
+                "last_date": last_date,
+                "version": version,
+                "title": title,
+                "head": head,
+            }
+            for page_id, etag, hours, budget, last_date, version, title, head
+            in self.cursor.fetchall()
+        }
+
+    def set_pages(self, pages):
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO pages (id, etag, hours, budget, last_date, version, title, "
+            "head) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    page_id,
+                    page["etag"],
+                    page["hours"],
+                    page["budget"],
+                    page["last_date"],
+                    page["version"],
+                    page["title"],
+                    page["head"],
+                )
+                for page_id, page in pages.items()
+            ],
         )
 
     def commit(self):
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO projects (name, hours) VALUES (?, ?)",
+            self.pending.items(),
+        )
+        self.pending.clear()
         self.connection.commit()
 
     def close(self):
-        self.connection.commit()
+        self.commit()
         self.connection.close()
 
 
 class Confluence:
-    def __init__(self, api_url, user, api_token, upload, force):
+    def __init__(self, api_url, user, api_token, upload, force, api_v2_url=None, pages=None):
         """
         force -- do not skip generating new content if hours are unchanged
         upload -- whether to upload anything to Confluence (use for a 'dry run'
             option)
+        api_v2_url -- URL of the v2 REST API (default: derived from api_url,
+            .../wiki/rest/api becomes .../wiki/api/v2)
+        pages -- known state of the report pages, as returned by
+            Database.pages(). It is kept up to date in self.pages, and the ids
+            of the pages that changed during this run are added to
+            self.remembered.
         """
         self.apiurl = api_url
+        self.apiurl_v2 = api_v2_url or re.sub(r"/rest/api/?$", "/api/v2", api_url)
         self.auth   = requests.auth.HTTPBasicAuth(user, api_token)
         self.upload = upload
         self.force  = force
+        self.pages  = pages if pages is not None else {}
+        self.remembered = set()
+
+        # Keep connections to Confluence alive across requests and threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.5),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.auth = self.auth
+        self.session.headers.update({"Content-Type": "application/json"})
 
     def find_pages(self, title="TimeLog"):
         """
         Search Confluence for all pages with the given title.
         Return a list of (id, space_name) tuples.
-        TODO: Should handle pagination, will miss projects in the future when we hit 1000.
         """
-        params = {"title": title, "expand": "space", "limit": 1000}
-        r = requests.get(
-            self.apiurl + "/content", params=params, auth=self.auth, timeout=20
+        # Like v1 /content, only consider current pages, not archived ones
+        pages = self.get_all(
+            self.apiurl_v2 + "/pages", {"title": title, "status": "current", "limit": 250}
+        )
+
+        # Look up the names of all spaces at once, in chunks of at most
+        # SPACE_IDS_PER_REQUEST ids to keep the URLs short
+        space_ids = sorted({str(page["spaceId"]) for page in pages})
+        space_names = {}
+        for start in range(0, len(space_ids), SPACE_IDS_PER_REQUEST):
+            ids = space_ids[start : start + SPACE_IDS_PER_REQUEST]
+            spaces = self.get_all(
+                self.apiurl_v2 + "/spaces", {"ids": ",".join(ids), "limit": 250}
+            )
+            space_names.update((str(space["id"]), space["name"]) for space in spaces)
+
+        found = []
+        for page in pages:
+            space_name = space_names.get(str(page["spaceId"]))
+            if space_name is None:
+                # e.g. no permission to view the space
+                print("Page {}: ignored, name of space {} not found.".format(page["id"], page["spaceId"]))
+                continue
+            found.append((page["id"], space_name))
+        return found
+
+    def get_all(self, url, params):
+        """
+        Retrieve all results from a cursor-paginated v2 API endpoint by
+        following the 'next' links until there are none left.
+        """
+        results = []
+        while url is not None:
+            r = self.session.get(url, params=params, timeout=20)
+            r.raise_for_status()
+            results.extend(r.json()["results"])
+            next_link = r.links.get("next")
+            # The next link is relative and already contains all query parameters
+            url = urljoin(url, next_link["url"]) if next_link else None
+            params = None
+        return results
+
+    def is_up_to_date(self, page_id, hours_spent, budget, last_date):
+        """
+        Return whether the page is known to show the given numbers already,
+        so that it does not need to be retrieved at all
+        """
+        page = self.pages.get(page_id)
+        return (
+            page is not None
+            and abs(hours_spent - page["hours"]) < 0.01
+            and abs(page["budget"] - budget) < 0.01
+            and page["last_date"] == last_date
         )
-        r.raise_for_status()
-        j = r.json()
-        return [(page["id"], page["space"]["name"]) for page in j["results"]]
 
-    def update_report_page(self, space_name, page_id, work_units, budget):
+    def update_report_page(self, space_name, page_id, hours_spent, monthly, budget, last_date=None):
         """
         Update report in a Confluence page. The report is only updated if the
         numbers have changed.
 
+        monthly -- list of (year, month, hours) tuples, most recent month first
+        last_date -- date of the most recent work unit, remembered in self.pages
+
         Return a bool indicating whether the report was updated.
         """
         url = self.apiurl + "/content/{id}".format(id=page_id)
-        # Retrieve current page
+        page = self.pages.get(page_id)
+        numbers_changed = page is None or (
+            abs(hours_spent - page["hours"]) >= 0.01 or abs(page["budget"] - budget) >= 0.01
+        )
+
+        # Upload the new report right away if the numbers have changed and the
+        # rest of the page is known from its last update. If the page has been
+        # edited since, Confluence rejects the version number with 409 Conflict
+        # and the page is retrieved and updated as usual. The ancestors are
+        # left out, so that the page is not moved back if it was moved without
+        # a new version.
+        if (
+            self.upload
+            and not self.force
+            and page is not None
+            and page["version"] is not None
+            and numbers_changed
+        ):
+            report = self.create_report(space_name, hours_spent, monthly, budget)
+            version = page["version"] + 1
+            r = self.put_page(url, page_id, page["title"], version, page["head"] + "\n" + report)
+            if r.status_code != 409:
+                r.raise_for_status()
+                self.remember_page(
+                    page_id, None, page["title"], version, page["head"], hours_spent, budget, last_date
+                )
+                return True
+
+        # Retrieve current page. If it last showed the current numbers when it
+        # was retrieved, only ask for it in case it has changed since. This is
+        # also the case when only the date of the most recent work unit changed.
         params = {"expand": "body.storage,version,ancestors"}
-        j = requests.get(url, params=params, auth=self.auth).json()
+        headers = {}
+        if not numbers_changed and page["etag"] is not None and not self.force:
+            headers["If-None-Match"] = page["etag"]
+        r = self.session.get(url, params=params, headers=headers)
+        if r.status_code == 304:
+            # Remember the date of the most recent work unit, which may have
+            # changed without changing the numbers
+            self.remember_page(
+                page_id, page["etag"], page["title"], page["version"], page["head"],
+                hours_spent, budget, last_date,
+            )
+            return False
+        r.raise_for_status()
+        j = r.json()
         text = j["body"]["storage"]["value"]
 
         # Modify text to include the new report
-
-        # The space in this constant is needed since the HTML gets cleaned up after uploading.
-        marker = "<hr />"
-
-        hours_spent = work_hours(work_units)
-        index = text.find(marker)
+        index = text.find(REPORT_MARKER)
         if index >= 0:
             if not self.force:
                 # Find out whether we need to update the report at all
-                previous_report = text[index:]
-                m = re.search("([0-9.]+) out of ([0-9.]+) hours used", previous_report)
+                m = REPORT_PATTERN.search(text, index, index + REPORT_HEADER_LENGTH)
                 if m is not None:
                     previous_hours_spent = float(m.group(1))
                     previous_budget = float(m.group(2))
@@ -132,66 +355,91 @@ class Confluence:
                         abs(hours_spent - previous_hours_spent) < 0.01
                         and abs(previous_budget - budget) < 0.01
                     ):
+                        self.remember_page(
+                            page_id, r.headers.get("ETag"), j["title"], j["version"]["number"],
+                            text[:index], hours_spent, budget, last_date,
+                        )
                         return False
 
             # Remove everything following the marker
-            text = text[: text.index(marker)]
+            text = text[:index]
+
+        report = self.create_report(space_name, hours_spent, monthly, budget)
+
+        # And upload it
+        if self.upload:
+            version = j["version"]["number"] + 1
+            r = self.put_page(
+                url, j["id"], j["title"], version, text + "\n" + report, ancestors=j["ancestors"]
+            )
+            r.raise_for_status()
+            self.remember_page(page_id, None, j["title"], version, text, hours_spent, budget, last_date)
+        return True
 
-        # Create the report
+    def create_report(self, space_name, hours_spent, monthly, budget):
         percent = hours_spent / budget if budget > 0 else 0.0
 
         # The <progress> tag gets filtered out unfortunately.
         # <progress value="{percent:.0%}" max="100"></progress>
-        report = """
+        header = """
             {marker}
             <h2>Project {project_name} is {percent:.1%} complete</h2>
             <p>{hours:.2f} out of {budget:.0f} hours used.</p>
         """.format(
-            marker=marker,
+            marker=REPORT_MARKER,
             project_name=space_name,
             percent=percent,
             hours=hours_spent,
             budget=budget,
         )
-        report = textwrap.dedent(report)
+        parts = [textwrap.dedent(header)]
 
         # Create the month report, most recent on top
-        report += "<p><table>\n"
-        report += "<tr><th>Date</th><th>Hours spent</th></tr>\n"
-        for (year, month), group in groupby(
-            sorted(work_units, key=lambda wu: wu['date'], reverse=True),
-            key=lambda wu: (wu['date'].year, wu['date'].month),
-        ):
-            hours = sum(unit['hours'] for unit in group)
-            formatted_date = date(year, month, 1).strftime("%B %Y")
-            report += "<tr><td>{}</td><td>{:.2f}</td></tr>\n".format(
-                formatted_date, hours
+        parts.append("<p><table>\n")
+        parts.append("<tr><th>Date</th><th>Hours spent</th></tr>\n")
+        parts.extend(
+            "<tr><td>{}</td><td>{:.2f}</td></tr>\n".format(
+                date(year, month, 1).strftime("%B %Y"), hours
             )
-        report += "</table></p>"
+            for year, month, hours in monthly
+        )
+        parts.append("</table></p>")
+        return "".join(parts)
 
-        # report += "<p><table><tr><td>a</td><td>b</td></tr></table></p>"
-        # Build the new page content
+    def put_page(self, url, page_id, title, version, text, ancestors=None):
+        """
+        Upload new page content and return the response. The page keeps its
+        current parent unless ancestors is given.
+        """
         content = {
-            "id": j["id"],
+            "id": page_id,
             "type": "page",
-            "title": j["title"],
-            "ancestors": j["ancestors"],
+            "title": title,
             "body": {
-                "storage": {"value": text + "\n" + report, "representation": "storage"}
+                "storage": {"value": text, "representation": "storage"}
             },
-            "version": {"number": j["version"]["number"] + 1},
+            "version": {"number": version},
         }
+        if ancestors is not None:
+            content["ancestors"] = ancestors
+        return self.session.put(url, data=json.dumps(content))
 
-        # And upload it
-        if self.upload:
-            r = requests.put(
-                url,
-                auth=self.auth,
-                data=json.dumps(content),
-                headers={"Content-Type": "application/json"},
-            )
-            r.raise_for_status()
-        return True
+    def remember_page(self, page_id, etag, title, version, head, hours_spent, budget, last_date):
+        """
+        Remember the state of a page after retrieving or updating it. head is
+        the page content preceding the report. etag is the ETag of the page as
+        retrieved, or None after updating it.
+        """
+        self.pages[page_id] = {
+            "etag": etag,
+            "hours": hours_spent,
+            "budget": budget,
+            "last_date": last_date,
+            "version": version,
+            "title": title,
+            "head": head,
+        }
+        self.remembered.add(page_id)
 
 
 def get_config(path):
@@ -220,6 +468,7 @@ class EMailer:
         self.user       = user
         self.password   = password
         self.port       = port
+        self.smtp       = None
 
     def send_email(self, subject, body, force=False):
         message            = MIMEText(body)
@@ -235,12 +484,40 @@ class EMailer:
             print("... and body:")
             print(body)
         else:
-            context = ssl.create_default_context()
-            s = smtplib.SMTP(self.host, port=self.port)
-            s.starttls(context=context)
-            s.login(self.user, self.password)
-            s.send_message(message)
-            s.quit()
+            try:
+                self.connect().send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                # The connection was lost after checking it, retry once with a new one
+                self.smtp = None
+                self.connect().send_message(message)
+
+    def connect(self):
+        """
+        Return a logged in SMTP connection. The connection is kept open for
+        further e-mails and reused as long as the server still responds.
+        """
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except smtplib.SMTPServerDisconnected:
+                pass
+            # e.g. "421 closing connection", the server is going away
+            self.close()
+        context = ssl.create_default_context()
+        s = smtplib.SMTP(self.host, port=self.port)
+        s.starttls(context=context)
+        s.login(self.user, self.password)
+        self.smtp = s
+        return s
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
 
     def update(self, name, hours, project_start_date):
         sent_email = False
@@ -277,12 +554,83 @@ class EMailer:
                 sent_email = True
         # Always do this to ensure the timestamp is updated even if the hours did not change
         self.db[name] = hours
-        self.db.commit()
         return sent_email
 
 
+def fetch_issues(redmine, redmine_project_id):
+    return list(redmine.issue.filter(project_id=redmine_project_id, status_id='*'))
+
+
+def custom_fields(issue):
+    """Return the custom fields of a Redmine issue as a {name: value} dict"""
+    return {
+        attr['name']: attr['value']
+        for attr in issue['_decoded_attrs'].get('custom_fields', [])
+    }
+
+
+def fetch_time_entries(redmine, redmine_project_id):
+    return list(redmine.time_entry.filter(project_id=redmine_project_id))
+
+
+def group_work_units(time_entries, issues):
+    """
+    Group time entries as work units by the id of the issue they were logged on,
+    most recent first. As when asking Redmine for the time entries of an issue,
+    the work units of an issue include those logged on its subtasks.
+    """
+    parents = {
+        issue['_decoded_attrs']['id']: issue['_decoded_attrs'].get('parent', {}).get('id')
+        for issue in issues
+    }
+    work_units = defaultdict(list)
+    seen = set()
+    for unit in sorted(time_entries, key=lambda unit: unit['_decoded_attrs']['spent_on'], reverse=True):
+        attrs = unit['_decoded_attrs']
+        # skip time logged directly on a project and entries fetched twice
+        # because both a project and its subproject are configured
+        if 'issue' not in attrs or attrs['id'] in seen:
+            continue
+        seen.add(attrs['id'])
+        work_unit = {'date':date.fromisoformat(attrs['spent_on']), 'hours':attrs['hours']}
+        issue_id = attrs['issue']['id']
+        while issue_id is not None:
+            work_units[issue_id].append(work_unit)
+            issue_id = parents.get(issue_id)
+    return work_units
+
+
 def work_hours(units):
-    return sum(work_unit['hours'] for work_unit in units)
+    # fsum avoids the rounding errors that add up over many small entries
+    return fsum(map(itemgetter('hours'), units))
+
+
+def monthly_hours(units):
+    """Return the hours spent per month as a {(year, month): hours} dict"""
+    totals = defaultdict(float)
+    for unit in units:
+        day = unit['date']
+        totals[(day.year, day.month)] += unit['hours']
+    return totals
+
+
+def update_monthly_hours(db, name, units):
+    """
+    Update the monthly hours stored for a project and return them as a list of
+    (year, month, hours) tuples, most recent month first.
+
+    All months are aggregated again, so that time logged, removed or moved
+    between months further back is picked up, but only the months whose hours
+    changed are written.
+    """
+    totals = monthly_hours(units)
+    stored = {(year, month): hours for year, month, hours in db.monthly_hours(name)}
+    db.set_monthly_hours(
+        name,
+        {month: hours for month, hours in totals.items() if stored.get(month) != hours},
+        removed=stored.keys() - totals.keys(),
+    )
+    return db.monthly_hours(name)
 
 
 def work_unit_to_json(unit):
@@ -293,15 +641,7 @@ def normalize_project_id(project_id):
     """
     Replace special characters with URL friendly variants.
     """
-    MAP = {
-        "ö": "o",
-        "ä": "a",
-        "å": "a",
-        "Ö": "O",
-        "Ä": "A",
-        "Å": "A",
-    }
-    return project_id.translate({ord(c): target for (c, target) in MAP.items()})
+    return project_id.translate(PROJECT_ID_TRANSLATION)
 
 
 def main():
@@ -343,37 +683,6 @@ def main():
 
     redmine = Redmine_api(config.redmine['url'], key=config.redmine['api_key'])
 
-    # get the issues related to desired redmine projects
-    projects = {}
-    for redmine_project_id in config.redmine['projects']:
-
-        # structure the data
-        for project in redmine.issue.filter(project_id=redmine_project_id, status_id='*'):
-
-            # get project id
-            try:
-                #pdb.set_trace()
-                project_id = [attr['value'] for attr in project['_decoded_attrs']['custom_fields'] if attr['name'] == 'WABI ID'][0]
-            except (IndexError, KeyError):
-                project_id = None
-
-            if project_id is None:
-
-                # try using the subject name, if it follows the project id pattern (should this be removed after development?)
-                if re.match(r'.*_\d{4}$', project['_decoded_attrs']['subject']):
-                    project_id = project['_decoded_attrs']['subject']
-                else:
-#                    print(project['_decoded_attrs']['status'])
-#                    if project['_decoded_attrs']['status']['name'] == 'In Progress':
-#                        pdb.set_trace()
-                    #pdb.set_trace()
-                    print("(redmine id {}) {:>25s}: ignored, no WABI ID attribute or compatible issue subject found.".format(project['_decoded_attrs']['id'], project['_decoded_attrs']['subject']))
-                    continue
-
-            # save the project id with special characters removed
-            projects[normalize_project_id(project_id)] = project
-
-
     # connect to confluence
     confluence = Confluence(
         config.confluence["api_url"],
@@ -381,75 +690,143 @@ def main():
         config.confluence["api_token"],
         upload=not args.dry_run,
         force=args.force,
+        api_v2_url=config.confluence.get("api_v2_url"),
+        pages=db.pages(),
     )
 
-    # find all timelog pages
-    pages = confluence.find_pages()
-    # print('Projects:', projects, sep='\n')
-    # print('Pages with title "TimeLog":', pages, sep='\n')
+    # always store what has been done so far, in particular which checkpoint
+    # e-mails have been sent, even if a later project fails
+    try:
+        # get the issues and all logged time related to desired redmine projects,
+        # one paginated bulk request per project instead of one request per issue
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            issues = executor.map(
+                lambda redmine_project_id: fetch_issues(redmine, redmine_project_id),
+                config.redmine['projects'],
+            )
+            time_entries = executor.map(
+                lambda redmine_project_id: fetch_time_entries(redmine, redmine_project_id),
+                config.redmine['projects'],
+            )
+            issues = [issue for project_issues in issues for issue in project_issues]
+            work_units_by_issue = group_work_units(
+                [unit for project_units in time_entries for unit in project_units], issues
+            )
 
-    # process logged time for each project
-    json_work_units = dict()
-    for i, (page_id, space_name) in enumerate(pages):
+            projects = {}
+            for project in issues:
 
-        space_name_norm = normalize_project_id(space_name)
+                # get project id
+                project_id = custom_fields(project).get('WABI ID')
 
-        # filter all spaces except the requested on, if one has been requested
-        if args.space is not None and args.space != space_name and args.space != space_name_norm:
-            print("{:>25s}: ignored due to --space option being set.".format(space_name))
+                if project_id is None:
 
-        # find the corresponding redmine project if possible
-        elif space_name_norm in projects or space_name_norm.replace("NBIS ", "") in projects:
-            try:
-                project = projects[space_name_norm]
-            except KeyError:
-                project = projects[space_name_norm.replace("NBIS ", "")]
-
-            # get logged time for project
-            work_units = [ {'date':datetime.strptime(unit['_decoded_attrs']['spent_on'], '%Y-%m-%d'), 'hours':unit['_decoded_attrs']['hours']} for unit in project.time_entries ]
-            json_work_units[space_name] = [
-                work_unit_to_json(unit) for unit in work_units
-            ]
-            hours_spent = work_hours(work_units)
-            # print('Project:\n', project)
-
-            # get the hour budget
-            try:
-                budget = float([attr['value'] for attr in project['_decoded_attrs']['custom_fields'] if attr['name'] == 'Hours ordered'][0])
-            except:
-                # set to zero if the budget for any reason can't be converted to a float (index, key, type errors)
-                budget = 0
+                    # try using the subject name, if it follows the project id pattern (should this be removed after development?)
+                    if WABI_ID_PATTERN.fullmatch(project['_decoded_attrs']['subject']):
+                        project_id = project['_decoded_attrs']['subject']
+                    else:
+                        print("(redmine id {}) {:>25s}: ignored, no WABI ID attribute or compatible issue subject found.".format(project['_decoded_attrs']['id'], project['_decoded_attrs']['subject']))
+                        continue
 
-            print(f"{i}/{len(pages)}\t",
-                    end="")
-            print(
-                    "(redmine id: {})\t{:>25s}: {:7.2f} of {:4.0f} hours: {:6.1%}".format(
-                    project['_decoded_attrs']['id'],
+                # save the project id with special characters removed
+                projects[normalize_project_id(project_id)] = project
+
+
+            # find all timelog pages
+            pages = confluence.find_pages()
+            # print('Projects:', projects, sep='\n')
+            # print('Pages with title "TimeLog":', pages, sep='\n')
+
+            # match the timelog pages to redmine projects
+            matched_pages = []
+            for i, (page_id, space_name) in enumerate(pages):
+
+                space_name_norm = normalize_project_id(space_name)
+
+                # filter all spaces except the requested on, if one has been requested
+                if args.space is not None and args.space != space_name and args.space != space_name_norm:
+                    print("{:>25s}: ignored due to --space option being set.".format(space_name))
+                    continue
+
+                # find the corresponding redmine project if possible
+                project = projects.get(space_name_norm) or projects.get(space_name_norm.removeprefix("NBIS "))
+                if project is not None:
+                    matched_pages.append((i, page_id, space_name, project))
+                else:
+                    print("{:>25s}: not found in Redmine".format(space_name.removeprefix("NBIS ")))
+
+            # update the timelog pages concurrently, reporting the results in page order
+            updates = []
+            for i, page_id, space_name, project in matched_pages:
+
+                # get logged time for project
+                work_units = work_units_by_issue.get(project['_decoded_attrs']['id'], [])
+                hours_spent = work_hours(work_units)
+                monthly = update_monthly_hours(db, project['_decoded_attrs']['subject'], work_units)
+
+                # get the hour budget
+                try:
+                    budget = float(custom_fields(project)['Hours ordered'])
+                except:
+                    # set to zero if the budget for any reason can't be converted to a float (key, type, value errors)
+                    budget = 0
+
+                # skip the page altogether if it already shows these numbers
+                last_date = work_units[0]['date'] if work_units else None
+                if not args.force and confluence.is_up_to_date(page_id, hours_spent, budget, last_date):
+                    future = None
+                else:
+                    future = executor.submit(
+                        confluence.update_report_page,
+                        space_name,
+                        page_id,
+                        hours_spent,
+                        monthly,
+                        budget,
+                        last_date,
+                    )
+                updates.append((i, space_name, project, work_units, hours_spent, budget, future))
+
+            json_work_units = dict()
+            for i, space_name, project, work_units, hours_spent, budget, future in updates:
+                if args.dump:
+                    json_work_units[space_name] = [
+                        work_unit_to_json(unit) for unit in work_units
+                    ]
+                # print('Project:\n', project)
+
+                print(f"{i}/{len(pages)}\t",
+                        end="")
+                print(
+                        "(redmine id: {})\t{:>25s}: {:7.2f} of {:4.0f} hours: {:6.1%}".format(
+                        project['_decoded_attrs']['id'],
+                        project['_decoded_attrs']['subject'],
+                        hours_spent,
+                        budget,
+                        hours_spent / budget if budget > 0 else 0.0,
+                    ),
+                    end=" ",
+                )
+                try:
+                    updated = future.result() if future is not None else False
+                    print("(updated)" if updated else "(not updated)")
+                except requests.exceptions.HTTPError as e:
+                    print("\nCould not update project {}: {}".format(space_name, e))
+                if work_units and emailer.update(
                     project['_decoded_attrs']['subject'],
                     hours_spent,
-                    budget,
-                    hours_spent / budget if budget > 0 else 0.0,
-                ),
-                end=" ",
-            )
-            try:
-                updated = confluence.update_report_page(
-                    space_name, page_id, work_units, budget
-                )
-                print("(updated)" if updated else "(not updated)")
-            except requests.exceptions.HTTPError as e:
-                print("\nCould not update project {}: {}".format(space_name, e))
-            if work_units and emailer.update(
-                project['_decoded_attrs']['subject'], hours_spent, project_start_date=work_units[-1]['date']
-            ):
-                print("E-Mail sent for", project['_decoded_attrs']['subject'])
-        else:
-            print("{:>25s}: not found in Redmine".format(space_name.replace("NBIS ", "")))
-    db.close()
+                    project_start_date=datetime.combine(work_units[-1]['date'], datetime.min.time()),
+                ):
+                    print("E-Mail sent for", project['_decoded_attrs']['subject'])
+    finally:
+        emailer.close()
+        db.set_pages({page_id: confluence.pages[page_id] for page_id in confluence.remembered})
+        db.close()
 
     if args.dump:
         with open(args.dump, "w") as f:
-            print(json.dumps(json_work_units, indent=2), file=f)
+            json.dump(json_work_units, f, indent=2)
+            f.write("\n")
 
 
 if __name__ == "__main__":
@@ -7,6 +7,9 @@ from datetime import datetime
 import smtplib
 from email.mime.text import MIMEText
 
+# Reuse connections to Redmine and Confluence across requests
+session = requests.Session()
+
 def load_config(config_file):
     with open(config_file, 'r') as file:
         return yaml.safe_load(file)
@@ -36,7 +39,7 @@ def fetch_time_entries(base_url, project_id):
     limit = 100
 
     while True:
-        response = requests.get(f'{config["redmine"]["base_url"]}/time_entries.json?project_id={project_id}&offset={offset}&limit={limit}', headers=headers)
+        response = session.get(f'{config["redmine"]["base_url"]}/time_entries.json?project_id={project_id}&offset={offset}&limit={limit}', headers=headers)
         if response.status_code != 200:
             raise Exception(f"Failed to fetch time entries: {response.content}")
 
@@ -56,7 +59,7 @@ def fetch_issues(config, project_id):
     limit = 100
 
     while True:
-        response = requests.get(f'{config["redmine"]["base_url"]}/issues.json?project_id={project_id}&offset={offset}&limit={limit}', headers=headers)
+        response = session.get(f'{config["redmine"]["base_url"]}/issues.json?project_id={project_id}&offset={offset}&limit={limit}', headers=headers)
         if response.status_code != 200:
             raise Exception(f"Failed to fetch issues: {response.content}")
 
@@ -80,14 +83,14 @@ def update_confluence(config, wabi_id, total_hours, monthly_hours):
     space_name = f"NBIS {wabi_id}"
     page_title = "TimeLogBot"
     
-    response = requests.get(f"{base_url}/rest/api/content?title={page_title}&spaceKey={space_name}", headers=headers)
+    response = session.get(f"{base_url}/rest/api/content?title={page_title}&spaceKey={space_name}", headers=headers)
     if response.status_code == 200:
         page_data = response.json()
         if page_data['size'] > 0:
             page_id = page_data['results'][0]['id']
             version = page_data['results'][0]['version']['number']
             
-            page_content_response = requests.get(f"{base_url}/rest/api/content/{page_id}?expand=body.storage", headers=headers)
+            page_content_response = session.get(f"{base_url}/rest/api/content/{page_id}?expand=body.storage", headers=headers)
             if page_content_response.status_code == 200:
                 page_content = page_content_response.json()
                 existing_body = page_content['body']['storage']['value']
@@ -115,7 +118,7 @@ def update_confluence(config, wabi_id, total_hours, monthly_hours):
                     }
                 }
                 
-                update_response = requests.put(f"{base_url}/rest/api/content/{page_id}", headers=headers, json=data)
+                update_response = session.put(f"{base_url}/rest/api/content/{page_id}", headers=headers, json=data)
                 return update_response.status_code == 200
     else:
         data = {
@@ -132,7 +135,7 @@ def update_confluence(config, wabi_id, total_hours, monthly_hours):
             }
         }
         
-        create_response = requests.post(f"{base_url}/rest/api/content/", headers=headers, json=data)
+        create_response = session.post(f"{base_url}/rest/api/content/", headers=headers, json=data)
         return create_response.status_code == 200
     return False
 